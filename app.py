@@ -1,28 +1,31 @@
 import streamlit as st
-import PyPDF2
-from openai import OpenAI
+import pypdfium2 as pdfium
+from openai import OpenAI, AsyncOpenAI
+import asyncio
 import io
-import json
+import orjson
 import os
 from datetime import datetime
 import re
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 import hashlib
+import pickle
+import shelve
+import threading
+import time
+import atexit
+import numpy as np
+import tiktoken
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional; the kernels below run as plain Python without it
+    def njit(*args, **kwargs):
+        return lambda func: func
 from dotenv import load_dotenv
 
-# Load environment variables from .env file
-load_dotenv()
-
-# Configure page
-st.set_page_config(
-    page_title="📚 EduInsights - PDF Intelligence for Learning",
-    page_icon="📚",
-    layout="wide",
-    initial_sidebar_state="expanded"
-)
-
-# Custom CSS for better UI
-st.markdown("""
+# Page styles, defined once at module scope
+CUSTOM_CSS = """
 <style>
     .main-header {
         background: linear-gradient(90deg, #667eea 0%, #764ba2 100%);
@@ -41,30 +44,6 @@ st.markdown("""
         margin: 1rem 0;
     }
     
-    .insight-box {
-        background: linear-gradient(135deg, #f5f7ff 0%, #e8f2ff 100%);
-        padding: 1.5rem;
-        border-radius: 10px;
-        border: 1px solid #d1e7dd;
-        margin: 1rem 0;
-    }
-    
-    .question-box {
-        background: #fff3cd;
-        padding: 1rem;
-        border-radius: 8px;
-        border-left: 4px solid #ffc107;
-        margin: 0.5rem 0;
-    }
-    
-    .answer-box {
-        background: #d1e7dd;
-        padding: 1rem;
-        border-radius: 8px;
-        border-left: 4px solid #198754;
-        margin: 0.5rem 0;
-    }
-    
     .stats-card {
         background: white;
         padding: 1rem;
@@ -73,10 +52,283 @@ st.markdown("""
         text-align: center;
     }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+# HTML templates for the repeated cards
+STATS_CARD_TEMPLATE = '<div class="stats-card"><h3>{label}</h3><h2>{value}</h2></div>'
+FEATURE_CARD_TEMPLATE = '<div class="feature-card"><h3>{title}</h3><p>{text}</p></div>'
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Configure page
+st.set_page_config(
+    page_title="📚 EduInsights - PDF Intelligence for Learning",
+    page_icon="📚",
+    layout="wide",
+    initial_sidebar_state="expanded"
+)
+
+# Custom CSS for better UI
+st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
+
+# Chat model used for every analysis
+GPT_MODEL = "gpt-4o-mini"
+
+# Document tokens sent per request; the model's context is far larger, this
+# keeps the input cost of each request bounded
+CONTEXT_TOKENS = 12000
+
+# Rough characters per token, used when the tokenizer can't be loaded
+CHARS_PER_TOKEN = 4
+
+# Long documents are summarized in sections of this many characters, with
+# at most this many section requests in flight
+SUMMARY_CHUNK_CHARS = 8000
+SUMMARY_CONCURRENCY = 10
+
+# Embedding model, and the most inputs the endpoint accepts per request
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_BATCH_SIZE = 2048
+# The endpoint also caps a request at 300k tokens; counts come from the
+# chat tokenizer, so keep some headroom
+EMBEDDING_BATCH_TOKENS = 250000
+
+# Q&A retrieval: characters per indexed chunk and chunks sent per question
+QA_CHUNK_CHARS = 1000
+QA_TOP_K = 5
+
+# Where document chunk embeddings are persisted, one file per document
+EMBEDDING_INDEX_DIR = os.path.expanduser("~/.eduinsights_index")
+
+# Where answers reused across similar questions are persisted
+SEMANTIC_CACHE_PATH = os.path.expanduser("~/.eduinsights_cache.pkl")
+
+# Where exact GPT responses are persisted, keyed by request hash
+RESPONSE_CACHE_PATH = ".gpt_cache.db"
+
+# What each analysis tab asks for; all of them are answered in one request
+ANALYSIS_TASKS = {
+    "summary": "A comprehensive summary for {user_type}s covering 1. Main Topic Overview, 2. Key Concepts and Ideas, 3. Important Details and 4. Educational Value. Make it detailed but accessible for educational purposes.",
+    "key_points": "The 8-12 most important key points for study purposes, as a clear, organized list. Format each point clearly and concisely.",
+    "study_questions": "10 numbered study questions suitable for student assessment: 4 factual/recall questions, 3 analytical/understanding questions and 3 application/critical thinking questions.",
+    "teaching_notes": "Comprehensive teaching notes for educators, formatted professionally for classroom use, with 1. Learning Objectives, 2. Key Teaching Points, 3. Discussion Questions, 4. Activity Suggestions and 5. Assessment Ideas."
+}
+
+# Output token budget per task; generation time grows with output length
+TASK_MAX_TOKENS = {
+    "summary": 800,
+    "key_points": 600,
+    "study_questions": 700,
+    "answer": 500,
+    "teaching_notes": 1200
+}
+
+@njit(cache=True)
+def _chunk_ends(offsets: np.ndarray, chunk_size: int) -> np.ndarray:
+    """Word index where each chunk ends, from word start offsets in the joined text"""
+    word_count = len(offsets) - 1
+    ends = np.empty(word_count, dtype=np.int64)
+    chunk_count = 0
+    start = 0
+    while start < word_count:
+        # Furthest end whose chunk fits in chunk_size, but at least one word
+        end = np.searchsorted(offsets, offsets[start] + chunk_size + 1, side="right") - 1
+        end = max(end, start + 1)
+        ends[chunk_count] = end
+        chunk_count += 1
+        start = end
+    return ends[:chunk_count]
+
+def _extract_pages(pdf, start: int, stop: int) -> str:
+    """Extract text from pages [start, stop), closing each page as we go"""
+    # Sized up front so the buffer never resizes, then joined once
+    parts = [""] * (stop - start)
+    for index in range(start, stop):
+        page = pdf[index]
+        textpage = page.get_textpage()
+        try:
+            parts[index - start] = textpage.get_text_range()
+        finally:
+            textpage.close()
+            page.close()
+    return "\n".join(parts)
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def extract_text_cached(doc_hash: str, _pdf_bytes: bytes) -> str:
+    """Extract text from PDF bytes, reused across reruns for the same document"""
+    # Only doc_hash is hashed by Streamlit; the bytes are not hashed again.
+    # PDFium reads bytes in place, so the upload is never copied here.
+    # Extraction stays in this process: PDFium takes about a millisecond per
+    # text-heavy page, less than a worker process needs just to start
+    pdf = pdfium.PdfDocument(_pdf_bytes)
+    try:
+        return _extract_pages(pdf, 0, len(pdf)).strip()
+    finally:
+        # Free PDFium's copy of the document even if extraction fails
+        pdf.close()
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def count_words_cached(doc_hash: str, _text: str) -> int:
+    """Number of words in the document's text, without building a list of them"""
+    return sum(1 for _ in re.finditer(r"\S+", _text))
+
+class SemanticCache:
+    """Answers keyed by question embedding, reused for near-identical questions"""
+    
+    def __init__(self, path: str, threshold: float = 0.92, max_entries: int = 1000, save_interval: float = 60.0):
+        self.path = path
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.save_interval = save_interval
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        # (namespace, unit embedding, answer) tuples, least recently used first
+        self.entries = []
+        self.unsaved = 0
+        self.saved_at = time.monotonic()
+        
+        if os.path.exists(path):
+            try:
+                with open(path, "rb") as f:
+                    self.entries = pickle.load(f)
+            except Exception:
+                self.entries = []
+    
+    def lookup(self, namespace: str, embedding: np.ndarray) -> Optional[str]:
+        """Return the cached answer most similar to the embedding, if close enough"""
+        with self.lock:
+            indices = [i for i, entry in enumerate(self.entries) if entry[0] == namespace]
+            if not indices:
+                return None
+            
+            # One matrix-vector product scores every candidate at once
+            similarities = np.stack([self.entries[i][1] for i in indices]) @ embedding
+            best = int(similarities.argmax())
+            if similarities[best] < self.threshold:
+                return None
+            
+            entry = self.entries.pop(indices[best])
+            self.entries.append(entry)
+            return entry[2]
+    
+    def store(self, namespace: str, embedding: np.ndarray, answer: str):
+        """Add an answer, evicting the least recently used entries past the limit"""
+        with self.lock:
+            self.entries.append((namespace, embedding, answer))
+            del self.entries[:-self.max_entries]
+            self.unsaved += 1
+            # The whole cache is rewritten on save, so at most once per interval
+            due = time.monotonic() - self.saved_at >= self.save_interval
+        if due:
+            self.save()
+    
+    def save(self):
+        """Write unsaved entries to disk without holding up lookups"""
+        with self.lock:
+            if not self.unsaved:
+                return
+            entries = list(self.entries)
+            self.unsaved = 0
+            self.saved_at = time.monotonic()
+        
+        with self.save_lock:
+            # Replace the file whole so a crash mid-write never corrupts it
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, "wb") as f:
+                pickle.dump(entries, f)
+            os.replace(temp_path, self.path)
+
+@st.cache_resource
+def get_semantic_cache() -> SemanticCache:
+    """Share one semantic cache across reruns and sessions"""
+    cache = SemanticCache(SEMANTIC_CACHE_PATH)
+    # Answers stored since the last periodic save are written on shutdown
+    atexit.register(cache.save)
+    return cache
+
+class ResponseStore:
+    """GPT responses keyed by a hash of the exact request that produced them"""
+    
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.db = shelve.open(path)
+    
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            return self.db.get(key)
+    
+    def set(self, key: str, text: str):
+        with self.lock:
+            self.db[key] = text
+            self.db.sync()
+
+@st.cache_resource
+def get_response_store() -> ResponseStore:
+    """Share one response store across reruns and sessions"""
+    return ResponseStore(RESPONSE_CACHE_PATH)
+
+@st.cache_resource
+def get_encoding() -> Optional[tiktoken.Encoding]:
+    """Load the chat model's tokenizer once per process, or None if unavailable"""
+    try:
+        return tiktoken.encoding_for_model(GPT_MODEL)
+    except Exception:
+        # The BPE file is downloaded on first use, which fails offline
+        return None
+
+def count_tokens(text: str) -> int:
+    """Number of chat model tokens in text, estimated without the tokenizer"""
+    encoding = get_encoding()
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+def fit_tokens(text: str, budget: int) -> str:
+    """Truncate text to at most budget tokens of the chat model"""
+    encoding = get_encoding()
+    if encoding is None:
+        return text[:budget * CHARS_PER_TOKEN]
+    # PDFs can contain literal special-token strings; treat them as text
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= budget:
+        return text
+    return encoding.decode(tokens[:budget])
+
+def to_markdown(value, depth: int = 0) -> str:
+    """Render a JSON value from the model as Markdown rather than a Python repr"""
+    indent = "  " * depth
+    if isinstance(value, list):
+        lines = []
+        for item in value:
+            if isinstance(item, dict) and not any(isinstance(field, (dict, list)) for field in item.values()):
+                # A flat record, such as a question and its type, reads as one line
+                lines.append(f"{indent}- " + " — ".join(str(field) for field in item.values()))
+            elif isinstance(item, (dict, list)):
+                lines.append(to_markdown(item, depth + 1))
+            else:
+                lines.append(f"{indent}- {item}")
+        return "\n".join(lines)
+    if isinstance(value, dict):
+        lines = []
+        for key, item in value.items():
+            if isinstance(item, (dict, list)):
+                lines.append(f"{indent}- **{key}**\n{to_markdown(item, depth + 1)}")
+            else:
+                lines.append(f"{indent}- **{key}:** {item}")
+        return "\n".join(lines)
+    return str(value)
+
+@st.cache_resource
+def get_openai_client(api_key: str) -> OpenAI:
+    """Share one OpenAI client, and its connection pool, across reruns"""
+    return OpenAI(api_key=api_key, max_retries=3, timeout=60.0)
 
 class PDFInsightsApp:
     def __init__(self):
+        self.aclient = None
+        self.temperature = 0.7
+        self.kv = get_response_store()
         self.setup_openai()
         
     def setup_openai(self):
@@ -85,20 +337,15 @@ class PDFInsightsApp:
         api_key = os.getenv('OPENAI_API_KEY')
         if api_key:
             st.session_state.openai_api_key = api_key
+            self.client = get_openai_client(api_key)
         else:
             st.session_state.openai_api_key = None
+            self.client = None
             
-    def extract_text_from_pdf(self, pdf_file) -> str:
+    def extract_text_from_pdf(self, doc_hash: str, pdf_bytes: bytes) -> str:
         """Extract text from uploaded PDF"""
         try:
-            pdf_reader = PyPDF2.PdfReader(pdf_file)
-            text = ""
-            
-            for page_num in range(len(pdf_reader.pages)):
-                page = pdf_reader.pages[page_num]
-                text += page.extract_text() + "\n"
-                
-            return text.strip()
+            return extract_text_cached(doc_hash, pdf_bytes)
         except Exception as e:
             st.error(f"Error extracting text from PDF: {str(e)}")
             return ""
@@ -106,126 +353,430 @@ class PDFInsightsApp:
     def chunk_text(self, text: str, chunk_size: int = 3000) -> List[str]:
         """Split text into manageable chunks"""
         words = text.split()
-        chunks = []
-        current_chunk = []
-        current_size = 0
-        
-        for word in words:
-            current_size += len(word) + 1
-            if current_size > chunk_size and current_chunk:
-                chunks.append(" ".join(current_chunk))
-                current_chunk = [word]
-                current_size = len(word)
-            else:
-                current_chunk.append(word)
+        if not words:
+            return []
         
-        if current_chunk:
-            chunks.append(" ".join(current_chunk))
-            
-        return chunks
+        # offsets[i] is where word i starts in the space-joined text, so chunk
+        # ends are found by binary search instead of a loop over every word
+        lengths = np.fromiter((len(word) + 1 for word in words), dtype=np.int64, count=len(words))
+        offsets = np.concatenate((np.zeros(1, dtype=np.int64), lengths.cumsum()))
+        ends = _chunk_ends(offsets, chunk_size)
+        starts = np.concatenate((np.zeros(1, dtype=np.int64), ends[:-1]))
+        
+        joined = " ".join(words)
+        return [joined[offsets[start]:offsets[end] - 1] for start, end in zip(starts, ends)]
     
-    def call_gpt(self, prompt: str, api_key: str) -> str:
-        """Make API call to GPT-3.5-turbo using new OpenAI client"""
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        """Embed texts as rows of unit vectors so dot products are cosine similarities"""
+        # Few large requests rather than one per text, each within both the
+        # endpoint's input count and token limits
+        spans, start, batch_tokens = [], 0, 0
+        for index, text in enumerate(texts):
+            tokens = count_tokens(text)
+            if index > start and (index - start == EMBEDDING_BATCH_SIZE or batch_tokens + tokens > EMBEDDING_BATCH_TOKENS):
+                spans.append((start, index))
+                start, batch_tokens = index, 0
+            batch_tokens += tokens
+        spans.append((start, len(texts)))
+        
+        batches = []
+        for start, stop in spans:
+            response = self.client.embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=texts[start:stop]
+            )
+            batches.append(np.asarray([item.embedding for item in response.data], dtype=np.float32))
+        
+        embeddings = np.concatenate(batches)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings
+    
+    def embed(self, text: str) -> np.ndarray:
+        """Embed a single text as a unit vector"""
+        return self.embed_texts([text])[0]
+    
+    def _chat_request(self, prompt: str, max_tokens: int = 800, json_mode: bool = False) -> Dict:
+        """Build the chat completion arguments shared by sync and async calls"""
+        request = {
+            "model": GPT_MODEL,
+            "messages": [
+                {"role": "system", "content": "You are an educational AI assistant specializing in document analysis and creating study materials for students and teachers."},
+                {"role": "user", "content": prompt}
+            ],
+            "max_tokens": max_tokens,
+            "temperature": self.temperature
+        }
+        if json_mode:
+            request["response_format"] = {"type": "json_object"}
+        return request
+    
+    def _cache_key(self, request: Dict) -> str:
+        """Hash everything that affects the completion: model, prompts, settings"""
+        return hashlib.sha256(orjson.dumps(request, option=orjson.OPT_SORT_KEYS)).hexdigest()
+    
+    def _cacheable(self, request: Dict) -> bool:
+        """Only temperature 0 replies are stable enough to reuse"""
+        return request["temperature"] == 0
+    
+    def _reusable(self, text: str, finish_reason: str, json_mode: bool) -> bool:
+        """Whether a reply may be stored; JSON replies must be complete objects"""
+        if not json_mode:
+            return True
+        if finish_reason != "stop":
+            return False
         try:
-            client = OpenAI(api_key=api_key)
+            return isinstance(orjson.loads(text), dict)
+        except orjson.JSONDecodeError:
+            return False
+    
+    def call_gpt(self, prompt: str, placeholder=None, max_tokens: int = 800) -> str:
+        """Make API call to the chat model, streaming into placeholder if given"""
+        request = self._chat_request(prompt, max_tokens)
+        key = self._cache_key(request)
+        cacheable = self._cacheable(request)
+        cached = self.kv.get(key) if cacheable else None
+        if cached is not None:
+            return cached
+        
+        try:
+            if placeholder is None:
+                response = self.client.chat.completions.create(**request)
+                text = response.choices[0].message.content.strip()
+            else:
+                # Show tokens as they arrive instead of waiting for the full reply
+                stream = self.client.chat.completions.create(**request, stream=True)
+                parts = []
+                for chunk in stream:
+                    if chunk.choices:
+                        parts.append(chunk.choices[0].delta.content or "")
+                        placeholder.markdown("".join(parts))
+                text = "".join(parts).strip()
             
-            response = client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "You are an educational AI assistant specializing in document analysis and creating study materials for students and teachers."},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=1500,
-                temperature=0.7
-            )
+            if cacheable:
+                self.kv.set(key, text)
+            return text
+        except Exception as e:
+            st.error(f"Error calling GPT API: {str(e)}")
+            return ""
+    
+    async def acall_gpt(self, prompt: str, max_tokens: int = 800, json_mode: bool = False) -> str:
+        """Make API call to the chat model using the shared async client"""
+        request = self._chat_request(prompt, max_tokens, json_mode)
+        key = self._cache_key(request)
+        cacheable = self._cacheable(request)
+        cached = self.kv.get(key) if cacheable else None
+        if cached is not None:
+            return cached
+        
+        try:
+            response = await self.aclient.chat.completions.create(**request)
             
-            return response.choices[0].message.content.strip()
+            choice = response.choices[0]
+            text = choice.message.content.strip()
+            # A cut-off or malformed JSON reply is retried next time, not replayed
+            if cacheable and self._reusable(text, choice.finish_reason, json_mode):
+                self.kv.set(key, text)
+            return text
         except Exception as e:
             st.error(f"Error calling GPT API: {str(e)}")
             return ""
     
-    def generate_summary(self, text: str, api_key: str, user_type: str) -> str:
-        """Generate comprehensive summary"""
+    def analysis_tasks(self, user_type: str) -> List[str]:
+        """The analyses shown to the user type, in tab order"""
+        tasks = ["summary", "key_points", "study_questions"]
+        if user_type == "Teacher":
+            tasks.append("teaching_notes")
+        return tasks
+    
+    def _analysis_prompt(self, text: str, user_type: str, tasks: List[str]) -> str:
+        """Build one combined prompt for the requested analyses"""
+        instructions = "\n".join(
+            f'- "{key}": ' + ANALYSIS_TASKS[key].format(user_type=user_type.lower())
+            for key in tasks
+        )
         prompt = f"""
-        As an educational AI assistant, create a comprehensive summary of the following text for {user_type}.
+        Analyze the following educational content. Respond as a JSON object with exactly these keys, each holding a Markdown-formatted string:
+        {instructions}
         
-        Please provide:
-        1. Main Topic Overview
-        2. Key Concepts and Ideas
-        3. Important Details
-        4. Educational Value
-        
-        Text to summarize:
-        {text[:4000]}
-        
-        Make the summary detailed but accessible for educational purposes.
+        Text:
+        {fit_tokens(text, CONTEXT_TOKENS)}
         """
+        return prompt
+    
+    def _parse_analyses(self, tasks: List[str], response: str) -> Dict[str, str]:
+        """Split a combined JSON response into one Markdown string per task"""
+        try:
+            analyses = orjson.loads(response) if response else {}
+        except orjson.JSONDecodeError as e:
+            st.error(f"Error parsing GPT response: {str(e)}")
+            analyses = {}
+        if not isinstance(analyses, dict):
+            st.error("Error parsing GPT response: expected a JSON object")
+            analyses = {}
         
-        return self.call_gpt(prompt, api_key)
+        # Sections sometimes come back as nested objects or arrays
+        return {key: to_markdown(analyses.get(key, "")).strip() for key in tasks}
     
-    def extract_key_points(self, text: str, api_key: str) -> str:
-        """Extract key points for study"""
-        prompt = f"""
-        Extract the most important key points from this educational content. Format as a clear, organized list:
+    async def generate_all(self, text: str, user_type: str, tasks: List[str]) -> Dict[str, str]:
+        """Generate the requested analyses in a single request"""
+        prompt = self._analysis_prompt(text, user_type, tasks)
+        max_tokens = sum(TASK_MAX_TOKENS[task] for task in tasks)
+        response = await self.acall_gpt(prompt, max_tokens=max_tokens, json_mode=True)
+        return self._parse_analyses(tasks, response)
+    
+    def submit_batch(self, requests: Dict[str, Dict]) -> str:
+        """Queue chat requests on the Batch API, keyed by custom_id"""
+        lines = [
+            orjson.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": body
+            })
+            for custom_id, body in requests.items()
+        ]
         
-        Text:
-        {text[:4000]}
+        batch_file = self.client.files.create(
+            file=("requests.jsonl", b"\n".join(lines)),
+            purpose="batch"
+        )
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        return batch.id
+    
+    def queue_analyses(self, text: str, user_type: str) -> Optional[Dict]:
+        """Queue the combined analyses request for half-price batch processing"""
+        tasks = self.analysis_tasks(user_type)
+        prompt = self._analysis_prompt(text, user_type, tasks)
+        max_tokens = sum(TASK_MAX_TOKENS[task] for task in tasks)
+        request = self._chat_request(prompt, max_tokens=max_tokens, json_mode=True)
+        # The cache key doubles as custom_id so the result can fill the cache
+        custom_id = self._cache_key(request)
         
-        Provide 8-12 key points that capture the essential information for study purposes.
-        Format each point clearly and concisely.
-        """
+        try:
+            batch_id = self.submit_batch({custom_id: request})
+        except Exception as e:
+            st.error(f"Error submitting batch: {str(e)}")
+            return None
+        return {
+            "id": batch_id,
+            "custom_id": custom_id,
+            "tasks": tasks,
+            "cacheable": self._cacheable(request),
+            "status": "validating"
+        }
+    
+    def cancel_batch(self, batch: Dict) -> bool:
+        """Cancel a queued analyses batch, returning whether the request went through"""
+        try:
+            self.client.batches.cancel(batch["id"])
+        except Exception as e:
+            st.error(f"Error cancelling batch: {str(e)}")
+            return False
+        return True
+    
+    def collect_batch(self, batch: Dict) -> Tuple[str, Optional[Dict[str, str]]]:
+        """Poll a queued analyses batch, returning its status and any results"""
+        try:
+            status = self.client.batches.retrieve(batch["id"])
+            if status.status != "completed":
+                return status.status, None
+            # Completed batches whose requests all errored have no output file
+            if not status.output_file_id:
+                return "failed", None
+            
+            output = self.client.files.content(status.output_file_id).content
+        except Exception as e:
+            st.error(f"Error checking batch status: {str(e)}")
+            return "unavailable", None
         
-        return self.call_gpt(prompt, api_key)
+        # Anything unusable fails the batch so it is dropped, not re-read on every rerun
+        try:
+            response = None
+            for line in output.splitlines():
+                record = orjson.loads(line)
+                if record["custom_id"] != batch["custom_id"]:
+                    continue
+                if record.get("error") or record["response"]["status_code"] != 200:
+                    raise ValueError(f"request failed: {record.get('error') or record['response']['body']}")
+                choice = record["response"]["body"]["choices"][0]
+                response = choice["message"]["content"].strip()
+                finish_reason = choice["finish_reason"]
+            
+            if response is None:
+                raise ValueError("no result for the queued request")
+            if not self._reusable(response, finish_reason, json_mode=True):
+                raise ValueError("the response was incomplete or not valid JSON")
+            results = self._parse_analyses(batch["tasks"], response)
+        except Exception as e:
+            st.error(f"Error reading batch results: {str(e)}")
+            return "failed", None
+        
+        if batch["cacheable"]:
+            self.kv.set(batch["custom_id"], response)
+        return status.status, results
     
-    def generate_study_questions(self, text: str, api_key: str) -> str:
-        """Generate study questions"""
-        prompt = f"""
-        Create 10 educational study questions based on this content. Include:
-        - 4 factual/recall questions
-        - 3 analytical/understanding questions  
-        - 3 application/critical thinking questions
+    def build_index(self, doc_hash: str, text: str) -> Tuple[List[str], np.ndarray]:
+        """Chunk and embed the document once, reusing a saved index if present"""
+        indexes = st.session_state.setdefault("qa_indexes", {})
+        if doc_hash in indexes:
+            return indexes[doc_hash]
         
-        Text:
-        {text[:4000]}
+        # An index is only valid for the chunking and embedding model that built it
+        path = os.path.join(EMBEDDING_INDEX_DIR, f"{doc_hash}-{EMBEDDING_MODEL}-{QA_CHUNK_CHARS}.pkl")
+        index = None
+        if os.path.exists(path):
+            try:
+                with open(path, "rb") as f:
+                    index = pickle.load(f)
+            except Exception:
+                # A corrupt or truncated index is rebuilt rather than failing every question
+                os.remove(path)
         
-        Format as numbered questions suitable for student assessment.
-        """
+        if index is None:
+            chunks = self.chunk_text(text, QA_CHUNK_CHARS)
+            index = (chunks, self.embed_texts(chunks))
+            
+            os.makedirs(EMBEDDING_INDEX_DIR, exist_ok=True)
+            temp_path = f"{path}.tmp"
+            with open(temp_path, "wb") as f:
+                pickle.dump(index, f)
+            os.replace(temp_path, path)
         
-        return self.call_gpt(prompt, api_key)
+        indexes[doc_hash] = index
+        return index
     
-    def answer_question(self, question: str, context: str, api_key: str) -> str:
-        """Answer specific question about the PDF"""
-        prompt = f"""
+    def retrieve(self, question_embedding: np.ndarray, chunks: List[str], embeddings: np.ndarray) -> str:
+        """Join the chunks most similar to the question, best match first"""
+        scores = embeddings @ question_embedding
+        k = min(QA_TOP_K, len(chunks))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return "\n---\n".join(chunks[i] for i in top)
+    
+    def _qa_prompt(self, question: str, context: str) -> str:
+        """Build the Q&A prompt around the given document context"""
+        return f"""
         Based on the provided context, answer the following question clearly and comprehensively:
         
         Question: {question}
         
         Context:
-        {context[:3500]}
+        {context}
         
         Provide a detailed, educational answer. If the answer isn't directly in the context, say so and provide the best related information available.
         """
+    
+    def answer_question(self, question: str, context: str, doc_hash: str, placeholder=None) -> str:
+        """Answer specific question about the PDF"""
+        # Near-identical questions about the same document reuse earlier
+        # answers, but like exact responses only in deterministic mode, and
+        # never across models
+        cache = get_semantic_cache()
+        use_cache = self.temperature == 0
+        namespace = f"qa:{GPT_MODEL}:{doc_hash}"
+        stats = st.session_state.setdefault("cache_stats", {"hits": 0, "misses": 0})
+        try:
+            embedding = self.embed(question)
+            cached = cache.lookup(namespace, embedding) if use_cache else None
+            if cached:
+                stats["hits"] += 1
+                return cached
+            
+            # Only the passages relevant to the question go into the prompt
+            chunks, chunk_embeddings = self.build_index(doc_hash, context)
+            prompt = self._qa_prompt(question, self.retrieve(embedding, chunks, chunk_embeddings))
+        except Exception as e:
+            st.error(f"Error calling embeddings API: {str(e)}")
+            prompt = self._qa_prompt(question, fit_tokens(context, CONTEXT_TOKENS))
+            return self.call_gpt(prompt, placeholder, TASK_MAX_TOKENS["answer"])
         
-        return self.call_gpt(prompt, api_key)
+        answer = self.call_gpt(prompt, placeholder, TASK_MAX_TOKENS["answer"])
+        if use_cache:
+            stats["misses"] += 1
+            if answer:
+                cache.store(namespace, embedding, answer)
+        return answer
     
-    def create_teaching_notes(self, text: str, api_key: str) -> str:
-        """Generate teaching notes for educators"""
-        prompt = f"""
-        Create comprehensive teaching notes for educators based on this content. Include:
+    async def summarize_doc(self, text: str, user_type: str) -> str:
+        """Summarize a long document section by section, then combine the parts"""
+        chunks = self.chunk_text(text, SUMMARY_CHUNK_CHARS)
+        # Bound the requests in flight to stay friendly with rate limits
+        semaphore = asyncio.Semaphore(SUMMARY_CONCURRENCY)
         
-        1. Learning Objectives
-        2. Key Teaching Points
-        3. Discussion Questions
-        4. Activity Suggestions
-        5. Assessment Ideas
+        async def summarize_chunk(chunk: str) -> str:
+            prompt = f"""
+            Summarize this section of a longer educational document, keeping its main ideas, key concepts and important details:
+            
+            {chunk}
+            """
+            async with semaphore:
+                return await self.acall_gpt(prompt)
         
-        Content:
-        {text[:4000]}
+        async def combine_group(group: List[str]) -> str:
+            joined = "\n\n".join(group)
+            prompt = f"""
+            These are summaries of consecutive sections of a longer educational document. Merge them into one summary, keeping its main ideas, key concepts and important details:
+            
+            {joined}
+            """
+            async with semaphore:
+                return await self.acall_gpt(prompt)
         
-        Format professionally for classroom use.
-        """
+        partials = await asyncio.gather(*(summarize_chunk(chunk) for chunk in chunks))
+        partials = [partial for partial in partials if partial]
+        
+        # Merge neighbouring summaries in rounds until they fit one request,
+        # so no part of a long document is cut from the final summary
+        while len(partials) > 1 and count_tokens("\n\n".join(partials)) > CONTEXT_TOKENS:
+            groups, group, group_tokens = [], [], 0
+            for partial in partials:
+                tokens = count_tokens(partial)
+                if group and group_tokens + tokens > CONTEXT_TOKENS:
+                    groups.append(group)
+                    group, group_tokens = [], 0
+                group.append(partial)
+                group_tokens += tokens
+            groups.append(group)
+            if len(groups) == len(partials):
+                # Every summary fills the budget on its own; merging can't help
+                break
+            merged = await asyncio.gather(*(combine_group(group) for group in groups))
+            partials = [partial for partial in merged if partial]
+        
+        sections = "\n\n".join(partials)
+        if not sections:
+            return ""
         
-        return self.call_gpt(prompt, api_key)
+        instructions = ANALYSIS_TASKS["summary"].format(user_type=user_type.lower())
+        prompt = f"""
+        These are summaries of consecutive sections of one educational document. Combine them into a single summary as described here:
+        {instructions}
+        
+        Section summaries:
+        {fit_tokens(sections, CONTEXT_TOKENS)}
+        """
+        return await self.acall_gpt(prompt, max_tokens=TASK_MAX_TOKENS["summary"])
+    
+    async def run_all(self, text: str, api_key: str, user_type: str) -> Dict[str, str]:
+        """Run every analysis for the document, keyed by the tab that shows it"""
+        # The async client's connection pool is tied to the running event
+        # loop, so one client serves all the calls of a single run
+        async with AsyncOpenAI(api_key=api_key, max_retries=3, timeout=60.0) as self.aclient:
+            tasks = self.analysis_tasks(user_type)
+            if count_tokens(text) <= CONTEXT_TOKENS:
+                return await self.generate_all(text, user_type, tasks)
+            
+            # Too long for one request: summarize the whole document with
+            # map-reduce while the other analyses run on the leading part
+            analyses, summary = await asyncio.gather(
+                self.generate_all(text, user_type, [task for task in tasks if task != "summary"]),
+                self.summarize_doc(text, user_type)
+            )
+            return {"summary": summary, **analyses}
 
 def main():
     app = PDFInsightsApp()
@@ -257,6 +808,12 @@ def main():
             help="This helps customize the analysis for your needs"
         )
         
+        deterministic = st.checkbox(
+            "🎯 Deterministic mode",
+            help="Use temperature 0 and reuse stored responses for repeated requests. Otherwise every request gets a fresh response"
+        )
+        app.temperature = 0.0 if deterministic else 0.7
+        
         st.header("📋 Features")
         st.markdown("""
         - **Smart Summarization**
@@ -266,6 +823,11 @@ def main():
         - **Teaching Notes**
         - **Educational Insights**
         """)
+        
+        cache_status = st.empty()
+        
+        if get_encoding() is None:
+            st.warning("⚠️ Tokenizer unavailable, so document length is estimated from characters. Restart once online to load it.")
     
     # Main content area
     api_key = os.getenv('OPENAI_API_KEY')
@@ -288,28 +850,22 @@ def main():
         col1, col2, col3 = st.columns(3)
         
         with col1:
-            st.markdown("""
-            <div class="feature-card">
-                <h3>🎯 For Students</h3>
-                <p>Get summaries, key points, and study questions from any PDF material</p>
-            </div>
-            """, unsafe_allow_html=True)
+            st.markdown(FEATURE_CARD_TEMPLATE.format(
+                title="🎯 For Students",
+                text="Get summaries, key points, and study questions from any PDF material"
+            ), unsafe_allow_html=True)
         
         with col2:
-            st.markdown("""
-            <div class="feature-card">
-                <h3>👩‍🏫 For Teachers</h3>
-                <p>Generate teaching notes, discussion questions, and assessment materials</p>
-            </div>
-            """, unsafe_allow_html=True)
+            st.markdown(FEATURE_CARD_TEMPLATE.format(
+                title="👩‍🏫 For Teachers",
+                text="Generate teaching notes, discussion questions, and assessment materials"
+            ), unsafe_allow_html=True)
         
         with col3:
-            st.markdown("""
-            <div class="feature-card">
-                <h3>🔍 For Researchers</h3>
-                <p>Extract insights, analyze content, and get detailed summaries</p>
-            </div>
-            """, unsafe_allow_html=True)
+            st.markdown(FEATURE_CARD_TEMPLATE.format(
+                title="🔍 For Researchers",
+                text="Extract insights, analyze content, and get detailed summaries"
+            ), unsafe_allow_html=True)
         
         return
     
@@ -322,45 +878,94 @@ def main():
     )
     
     if uploaded_file is not None:
+        pdf_bytes = uploaded_file.getvalue()
+        # Identifies the document for extraction and every GPT cache
+        doc_hash = hashlib.sha256(pdf_bytes).hexdigest()
+        
         # Extract text
         with st.spinner("🔍 Extracting text from PDF..."):
-            pdf_text = app.extract_text_from_pdf(uploaded_file)
+            pdf_text = app.extract_text_from_pdf(doc_hash, pdf_bytes)
         
         if pdf_text:
             # Display PDF stats
+            word_count = count_words_cached(doc_hash, pdf_text)
             col1, col2, col3, col4 = st.columns(4)
             
             with col1:
-                st.markdown("""
-                <div class="stats-card">
-                    <h3>📊 Words</h3>
-                    <h2>{}</h2>
-                </div>
-                """.format(len(pdf_text.split())), unsafe_allow_html=True)
+                st.markdown(STATS_CARD_TEMPLATE.format(
+                    label="📊 Words", value=word_count
+                ), unsafe_allow_html=True)
             
             with col2:
-                st.markdown("""
-                <div class="stats-card">
-                    <h3>📝 Characters</h3>
-                    <h2>{}</h2>
-                </div>
-                """.format(len(pdf_text)), unsafe_allow_html=True)
+                st.markdown(STATS_CARD_TEMPLATE.format(
+                    label="📝 Characters", value=len(pdf_text)
+                ), unsafe_allow_html=True)
             
             with col3:
-                st.markdown("""
-                <div class="stats-card">
-                    <h3>📄 File Size</h3>
-                    <h2>{:.1f} KB</h2>
-                </div>
-                """.format(uploaded_file.size / 1024), unsafe_allow_html=True)
+                st.markdown(STATS_CARD_TEMPLATE.format(
+                    label="📄 File Size", value=f"{uploaded_file.size / 1024:.1f} KB"
+                ), unsafe_allow_html=True)
             
             with col4:
-                st.markdown("""
-                <div class="stats-card">
-                    <h3>👤 Mode</h3>
-                    <h2>{}</h2>
-                </div>
-                """.format(user_type), unsafe_allow_html=True)
+                st.markdown(STATS_CARD_TEMPLATE.format(
+                    label="👤 Mode", value=user_type
+                ), unsafe_allow_html=True)
+            
+            # Run all analyses at once and keep them across reruns
+            analysis_key = (doc_hash, user_type)
+            analyses = st.session_state.setdefault("analyses", {})
+            batches = st.session_state.setdefault("batches", {})
+            
+            queue_batch = st.checkbox(
+                "🕒 Queue for batch processing (50% cheaper)",
+                help="Results arrive within 24 hours instead of seconds, at half the API price"
+            )
+            if queue_batch and count_tokens(pdf_text) > CONTEXT_TOKENS:
+                st.warning("⚠️ Batch mode analyzes only the beginning of long documents. Run it directly for a summary of the whole document.")
+            
+            # Placed here, but filled in once any pending batch is handled
+            analyze_slot = st.empty()
+            
+            # Poll a queued batch only on request; polling on every rerun
+            # would add a network call to each widget change for up to 24 hours
+            pending = batches.get(analysis_key)
+            if pending:
+                col1, col2 = st.columns(2)
+                check = col1.button("🔄 Check Batch Status")
+                cancel = col2.button("✖️ Cancel Batch")
+                
+                if cancel:
+                    if app.cancel_batch(pending):
+                        st.info("Batch cancelled. You can analyze the document again.")
+                        del batches[analysis_key]
+                elif check:
+                    status, batch_results = app.collect_batch(pending)
+                    pending["status"] = status
+                    if batch_results is not None:
+                        analyses[analysis_key] = batch_results
+                        del batches[analysis_key]
+                    elif status in ("failed", "expired", "cancelled"):
+                        st.error(f"❌ Batch processing {status}. Please analyze the document again.")
+                        del batches[analysis_key]
+                
+                if analysis_key in batches:
+                    st.info(f"🕒 Analysis queued for batch processing (status: {pending['status']}). Check its status to load the results once it completes.")
+            
+            # A pending batch would overwrite a newer analysis when it lands,
+            # so it has to be collected or cancelled first
+            if analyze_slot.button("🚀 Analyze Document", type="primary", disabled=analysis_key in batches):
+                if queue_batch:
+                    with st.spinner("📤 Queueing analysis for batch processing..."):
+                        batch = app.queue_analyses(pdf_text, user_type)
+                    if batch:
+                        batches[analysis_key] = batch
+                        # Show the batch controls straight away
+                        st.rerun()
+                else:
+                    with st.spinner("🤖 Generating summary, key points, study questions and notes..."):
+                        analyses[analysis_key] = asyncio.run(app.run_all(pdf_text, api_key, user_type))
+            
+            results = analyses.get(analysis_key, {})
             
             # Analysis tabs
             tab1, tab2, tab3, tab4, tab5 = st.tabs([
@@ -370,50 +975,29 @@ def main():
             with tab1:
                 st.header("📋 Comprehensive Summary")
                 
-                if st.button("Generate Summary", type="primary"):
-                    with st.spinner("🤖 Generating comprehensive summary..."):
-                        summary = app.generate_summary(pdf_text, api_key, user_type.lower())
-                    
-                    if summary:
-                        summary_html = summary.replace('\n', '<br>')
-                        st.markdown(f"""
-                        <div class="insight-box">
-                            <h3>📖 Summary for {user_type}s</h3>
-                            {summary_html}
-                        </div>
-                        """, unsafe_allow_html=True)
+                summary = results.get("summary")
+                if summary:
+                    st.markdown(f"### 📖 Summary for {user_type}s\n\n{summary}")
+                else:
+                    st.info("Click **Analyze Document** to generate the summary.")
             
             with tab2:
                 st.header("🎯 Key Points & Concepts")
                 
-                if st.button("Extract Key Points", type="primary"):
-                    with st.spinner("🔍 Extracting key educational points..."):
-                        key_points = app.extract_key_points(pdf_text, api_key)
-                    
-                    if key_points:
-                        key_points_html = key_points.replace('\n', '<br>')
-                        st.markdown(f"""
-                        <div class="insight-box">
-                            <h3>🎯 Essential Key Points</h3>
-                            {key_points_html}
-                        </div>
-                        """, unsafe_allow_html=True)
+                key_points = results.get("key_points")
+                if key_points:
+                    st.markdown(f"### 🎯 Essential Key Points\n\n{key_points}")
+                else:
+                    st.info("Click **Analyze Document** to extract the key points.")
             
             with tab3:
                 st.header("❓ Study Questions")
                 
-                if st.button("Generate Study Questions", type="primary"):
-                    with st.spinner("📝 Creating study questions..."):
-                        questions = app.generate_study_questions(pdf_text, api_key)
-                    
-                    if questions:
-                        questions_html = questions.replace('\n', '<br>')
-                        st.markdown(f"""
-                        <div class="insight-box">
-                            <h3>📚 Study Questions</h3>
-                            {questions_html}
-                        </div>
-                        """, unsafe_allow_html=True)
+                questions = results.get("study_questions")
+                if questions:
+                    st.markdown(f"### 📚 Study Questions\n\n{questions}")
+                else:
+                    st.info("Click **Analyze Document** to create the study questions.")
             
             with tab4:
                 st.header("💬 Ask Questions About the PDF")
@@ -424,36 +1008,23 @@ def main():
                 )
                 
                 if st.button("Get Answer", type="primary") and user_question:
+                    # The answer streams in here, then is replaced by the question and answer
+                    answer_area = st.empty()
                     with st.spinner("🤔 Finding the answer..."):
-                        answer = app.answer_question(user_question, pdf_text, api_key)
+                        answer = app.answer_question(user_question, pdf_text, doc_hash, answer_area)
                     
                     if answer:
-                        answer_html = answer.replace('\n', '<br>')
-                        st.markdown(f"""
-                        <div class="question-box">
-                            <strong>❓ Question:</strong> {user_question}
-                        </div>
-                        <div class="answer-box">
-                            <strong>💡 Answer:</strong><br>{answer_html}
-                        </div>
-                        """, unsafe_allow_html=True)
+                        answer_area.markdown(f"**❓ Question:** {user_question}\n\n**💡 Answer:**\n\n{answer}")
             
             with tab5:
                 if user_type == "Teacher":
                     st.header("📚 Teaching Notes & Materials")
                     
-                    if st.button("Generate Teaching Notes", type="primary"):
-                        with st.spinner("👩‍🏫 Creating teaching materials..."):
-                            teaching_notes = app.create_teaching_notes(pdf_text, api_key)
-                        
-                        if teaching_notes:
-                            teaching_notes_html = teaching_notes.replace('\n', '<br>')
-                            st.markdown(f"""
-                            <div class="insight-box">
-                                <h3>📋 Teaching Notes & Materials</h3>
-                                {teaching_notes_html}
-                            </div>
-                            """, unsafe_allow_html=True)
+                    teaching_notes = results.get("teaching_notes")
+                    if teaching_notes:
+                        st.markdown(f"### 📋 Teaching Notes & Materials\n\n{teaching_notes}")
+                    else:
+                        st.info("Click **Analyze Document** to create the teaching notes.")
                 else:
                     st.info("🎓 Teaching Notes are available when you select 'Teacher' as your user type in the sidebar.")
             
@@ -472,6 +1043,14 @@ def main():
         
         else:
             st.error("❌ Could not extract text from the PDF. Please try a different file.")
+    
+    # Filled in last so this run's cache lookups are counted
+    stats = st.session_state.get("cache_stats")
+    if stats and stats["hits"] + stats["misses"]:
+        lookups = stats["hits"] + stats["misses"]
+        cache_status.caption(
+            f"⚡ Answer cache: {stats['hits']}/{lookups} hits ({stats['hits'] / lookups:.0%})"
+        )
 
 if __name__ == "__main__":
     main()
\ No newline at end of file